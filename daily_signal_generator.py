@@ -1,13 +1,31 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time
 import datetime
 import os
-import json
-import matplotlib.pyplot as plt
+import hashlib
 from io import BytesIO
-import yfinance as yf
-import openai
 import traceback
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from collections import deque
+from itertools import islice
+
+# orjson이 설치되어 있으면 사용하고, 없으면 표준 json으로 같은 형식(바이트, 공백 없음)을 만듭니다.
+try:
+    import orjson
+    from orjson import loads as json_loads, JSONDecodeError
+
+    def json_dumps(obj, sort_keys=False):
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+except ImportError:
+    import json
+    from json import loads as json_loads, JSONDecodeError
+
+    def json_dumps(obj, sort_keys=False):
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), sort_keys=sort_keys).encode()
 
 # ---------- 환경 변수 및 초기 설정 ----------
 BOT_TOKEN = os.getenv("TELEGRAM_TOKEN")
@@ -17,58 +35,300 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 if not BOT_TOKEN or not CHAT_ID:
     raise EnvironmentError("FATAL ERROR: TELEGRAM_TOKEN or TELEGRAM_TO is not set in environment.")
 
-try:
-    openai_client = openai.OpenAI(api_key=OPENAI_API_KEY)
-except Exception:
-    openai_client = None
+TG_TEXT_URL = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
+TG_PHOTO_URL = f"https://api.telegram.org/bot{BOT_TOKEN}/sendPhoto"
+JSON_HEADERS = {"Content-Type": "application/json"}
+TG_CAPTION_LIMIT = 1024  # sendPhoto 캡션 최대 길이 (UTF-16 코드 단위)
+
+# 텔레그램 응답 디버그 출력은 DEBUG 환경 변수가 있을 때만 남깁니다.
+# 루트 로거는 건드리지 않아야 urllib3가 봇 토큰이 들어간 요청 URL을 DEBUG로 찍지 않습니다.
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG if os.getenv("DEBUG") else logging.WARNING)
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter("%(levelname)s: %(message)s"))
+logger.addHandler(_log_handler)
 
-DATA_FILE = "gold_premium_history.json"
+# openai/matplotlib는 import 비용이 커서 실제로 쓰는 시점에 불러옵니다.
+_openai_client = None
+
+def get_openai_client():
+    """AI 분석이 처음 필요할 때 OpenAI 클라이언트를 생성 (API 키가 없으면 import하지 않음)"""
+    global _openai_client
+    if _openai_client is None and OPENAI_API_KEY:
+        import openai
+        try:
+            _openai_client = openai.OpenAI(api_key=OPENAI_API_KEY)
+        except Exception:
+            _openai_client = None
+    return _openai_client
+
+# Telegram/Yahoo 호출이 TCP+TLS 연결을 재사용하도록 모듈 전역 세션 하나를 공유
+# Yahoo의 일시적인 429/5xx는 지수 백오프(+지터)로 재시도합니다. (Retry-After 헤더 우선)
+# 중복 발송을 막기 위해 POST(텔레그램 발송)는 재시도하지 않습니다.
+RETRY_POLICY = Retry(
+    total=3,
+    backoff_factor=0.5,
+    backoff_jitter=0.3,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods=["GET"],
+    respect_retry_after_header=True,
+    raise_on_status=False,
+)
+SESSION = requests.Session()
+SESSION.headers.update({"User-Agent": "Mozilla/5.0"})
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=RETRY_POLICY))
+
+DATA_FILE = "gold_premium_history.jsonl"  # 한 줄에 하루치 기록 (JSON Lines)
+LEGACY_DATA_FILE = "gold_premium_history.json"  # 이전 버전의 JSON 배열 형식
+HISTORY_MAX = 100  # 보관할 최대 기록 수
+HISTORY_TRIM_THRESHOLD = 200  # 파일이 이 줄 수를 넘으면 HISTORY_MAX로 정리
+HISTORY_TAIL_BYTES = 8192  # 읽을 때는 파일 끝에서 이만큼만 읽음 (HISTORY_MAX개 기록을 충분히 덮는 크기)
+QUOTE_CACHE_FILE = ".quote_cache.json"
+QUOTE_CACHE_TTL = 60  # 시세 캐시 기본 유효 시간 (초)
+# 심볼별 캐시 유효 시간 (초): 환율과 전일 종가 기준 ETF는 자주 바뀌지 않으므로 더 길게 유지
+QUOTE_CACHE_TTL_BY_SYMBOL = {"USDKRW=X": 300, "GC=F": 60, "411060.KS": 300}
+QUOTE_STALE_MAX = 3 * 24 * 60 * 60  # 조회 실패 시 대신 쓸 수 있는 캐시 시세의 최대 나이 (초, 주말 포함)
+AI_CACHE_DIR = ".ai_cache"
+AI_LAST_SUMMARY_FILE = os.path.join(AI_CACHE_DIR, "last.txt")
+AI_CACHE_TTL = 24 * 60 * 60  # AI 요약 캐시 유효 시간 (초)
+# 전일 대비 변화와 7일 평균 대비 차이가 모두 이 범위(%p) 안이면 직전 AI 요약을 재사용
+AI_NOISE_CHANGE = 0.05
+AI_NOISE_AVG = 0.1
+AI_MAX_TOKENS = 200  # 3줄 요약에 충분한 상한 (생성 길이가 곧 응답 지연)
+AI_TIMEOUT = 30  # OpenAI 요청 제한 시간 (초)
+GRAPH_CACHE_FILE = "graph.png"  # 마지막으로 그린 그래프
+GRAPH_SIG_FILE = ".graph_sig"  # 마지막 그래프를 그린 (날짜, 괴리율) 목록의 해시
 TROY_Ounce_TO_GRAM = 31.1035  # 1 트로이 온스 = 31.1035 그램
+KST = datetime.timezone(datetime.timedelta(hours=9))
 
 # ---------- 헬퍼 함수: Unix 타임스탬프를 KST 문자열로 변환 ----------
+@lru_cache(maxsize=32)
 def timestamp_to_kst(timestamp):
     """Unix 타임스탬프를 'YYYY-MM-DD HH:MM:SS KST' 형식으로 변환"""
     if timestamp is None:
         return "N/A"
     
-    dt_object = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
-    kst_tz = datetime.timezone(datetime.timedelta(hours=9))
-    kst_dt = dt_object.astimezone(kst_tz)
-    
-    return kst_dt.strftime('%Y-%m-%d %H:%M:%S KST')
+    return datetime.datetime.fromtimestamp(timestamp, KST).strftime('%Y-%m-%d %H:%M:%S KST')
 
 # ---------- 텔레그램 함수 ----------
 def send_telegram_text(msg):
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
-    payload = {"chat_id": CHAT_ID, "text": msg}
+    payload = json_dumps({"chat_id": CHAT_ID, "text": msg})
 
     try:
-        r = requests.post(url, json=payload, timeout=10)
-        
-        print(f"\n--- Telegram API Debug ---")
-        print(f"Status Code: {r.status_code}")
-        print(f"Response JSON: {r.text}")
-        print(f"--------------------------\n")
+        r = SESSION.post(TG_TEXT_URL, data=payload, headers=JSON_HEADERS, timeout=10)
+        logger.debug("Telegram API 응답: %s %s", r.status_code, r.text)
 
         r.raise_for_status()
     except requests.exceptions.RequestException as e:
         raise RuntimeError(f"텔레그램 메시지 발송 실패: {e}")
 
+def fit_caption(text, limit=TG_CAPTION_LIMIT):
+    """캡션 길이 제한을 넘으면 시세 메시지의 뒷부분을 잘라내고 말줄임표를 붙입니다."""
+    encoded = text.encode("utf-16-le")
+    if len(encoded) // 2 <= limit:
+        return text
+    # 잘린 서로게이트 쌍(이모지 절반)은 errors="ignore"로 버립니다.
+    return encoded[:(limit - 1) * 2].decode("utf-16-le", errors="ignore") + "…"
+
 def send_telegram_photo(image_bytes, caption=""):
     files = {"photo": image_bytes}
     data = {"chat_id": CHAT_ID, "caption": caption}
     
-    response = requests.post(f"https://api.telegram.org/bot{BOT_TOKEN}/sendPhoto", files=files, data=data, timeout=10)
+    response = SESSION.post(TG_PHOTO_URL, files=files, data=data, timeout=10)
     response.raise_for_status()
 
+# 0. Yahoo Finance 시세 일괄 조회 (여러 심볼을 한 번의 요청으로)
+YAHOO_QUOTE_URL = "https://query1.finance.yahoo.com/v7/finance/quote"
+YAHOO_CHART_URL = "https://query1.finance.yahoo.com/v8/finance/chart/{symbol}"
+YAHOO_SPARK_URL = "https://query1.finance.yahoo.com/v7/finance/spark"
+YAHOO_CRUMB_URL = "https://query1.finance.yahoo.com/v1/test/getcrumb"
+YAHOO_COOKIE_URL = "https://fc.yahoo.com"
+# quote 응답에서 실제로 쓰는 필드만 요청해 응답 크기를 줄입니다.
+YAHOO_QUOTE_FIELDS = "regularMarketPrice,regularMarketTime,regularMarketPreviousClose"
+_yahoo_crumb = None
+
+def get_yahoo_crumb():
+    """v7 quote 호출에 필요한 crumb을 프로세스당 한 번만 발급받아 재사용"""
+    global _yahoo_crumb
+    if _yahoo_crumb is None:
+        # fc.yahoo.com은 404를 반환하지만 crumb 발급에 필요한 쿠키를 세션에 심어줍니다.
+        SESSION.get(YAHOO_COOKIE_URL, timeout=10)
+        r = SESSION.get(YAHOO_CRUMB_URL, timeout=10)
+        r.raise_for_status()
+        _yahoo_crumb = r.text.strip()
+    return _yahoo_crumb
+
+def _fetch_quotes_batch(symbols):
+    """여러 심볼의 시세를 한 번의 HTTP 요청으로 조회하여 {심볼: {필드: 값}} 형태로 반환"""
+    try:
+        r = SESSION.get(
+            YAHOO_QUOTE_URL,
+            params={
+                "symbols": ",".join(symbols),
+                "fields": YAHOO_QUOTE_FIELDS,
+                "crumb": get_yahoo_crumb(),
+            },
+            timeout=10,
+        )
+        r.raise_for_status()
+        results = json_loads(r.content)["quoteResponse"]["result"]
+    except Exception as e:
+        raise RuntimeError(f"Yahoo Finance 일괄 시세 조회 실패: {type(e).__name__} - {e}")
+
+    quotes = {}
+    for item in results:
+        quotes[item["symbol"]] = {
+            "regularMarketPrice": item.get("regularMarketPrice"),
+            "regularMarketTime": item.get("regularMarketTime"),
+            # v7 quote 응답은 전일 종가를 'regularMarketPreviousClose'로 내려줍니다.
+            "previousClose": item.get("regularMarketPreviousClose", item.get("previousClose")),
+        }
+    return quotes
+
+def _quote_from_chart_meta(meta):
+    """chart/spark 응답의 meta 블록에서 필요한 필드만 추출"""
+    return {
+        "regularMarketPrice": meta.get("regularMarketPrice"),
+        "regularMarketTime": meta.get("regularMarketTime"),
+        "previousClose": meta.get("previousClose", meta.get("chartPreviousClose")),
+    }
+
+def _fetch_spark_batch(symbols):
+    """crumb 없이 동작하는 spark 엔드포인트로 여러 심볼의 meta를 한 번에 조회"""
+    try:
+        r = SESSION.get(
+            YAHOO_SPARK_URL,
+            params={"symbols": ",".join(symbols), "range": "1d", "interval": "1d"},
+            timeout=10,
+        )
+        r.raise_for_status()
+        results = json_loads(r.content)["spark"]["result"]
+    except Exception as e:
+        raise RuntimeError(f"Yahoo Finance spark 일괄 조회 실패: {type(e).__name__} - {e}")
+
+    quotes = {}
+    for item in results:
+        responses = item.get("response") or []
+        if responses and "meta" in responses[0]:
+            quotes[item["symbol"]] = _quote_from_chart_meta(responses[0]["meta"])
+    return quotes
+
+def _fetch_chart_quote(symbol):
+    """단일 심볼의 시세를 v8 chart 엔드포인트의 meta 블록에서 조회"""
+    try:
+        r = SESSION.get(
+            YAHOO_CHART_URL.format(symbol=symbol),
+            params={"range": "1d", "interval": "1d"},
+            timeout=10,
+        )
+        r.raise_for_status()
+        meta = json_loads(r.content)["chart"]["result"][0]["meta"]
+    except Exception as e:
+        raise RuntimeError(f"Yahoo Finance '{symbol}' 차트 조회 실패: {type(e).__name__} - {e}")
+
+    return _quote_from_chart_meta(meta)
+
+def _has_price(quote):
+    return bool(quote) and (quote.get("regularMarketPrice") is not None or quote.get("previousClose") is not None)
+
+def _fetch_quotes_remote(symbols):
+    """
+    quote → spark 순서로 일괄 조회를 시도하고, 그래도 빠진 심볼이 있으면
+    해당 심볼만 chart 요청을 병렬로 보내 대기 시간을 겹칩니다.
+    """
+    quotes = {}
+    for fetch_batch in (_fetch_quotes_batch, _fetch_spark_batch):
+        # 키는 있어도 가격이 비어 있는 심볼은 다음 단계에서 다시 조회합니다.
+        missing = [s for s in symbols if not _has_price(quotes.get(s))]
+        if not missing:
+            break
+        try:
+            quotes.update(fetch_batch(missing))
+        except RuntimeError as e:
+            logger.warning("%s", e)
+
+    missing = [s for s in symbols if not _has_price(quotes.get(s))]
+    if missing:
+        with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+            futures = {s: executor.submit(_fetch_chart_quote, s) for s in missing}
+        # 한 심볼이 실패해도 나머지 심볼의 시세는 살립니다.
+        for symbol, future in futures.items():
+            try:
+                quotes[symbol] = future.result()
+            except RuntimeError as e:
+                logger.warning("%s", e)
+    return quotes
+
+def load_quote_cache():
+    if os.path.exists(QUOTE_CACHE_FILE):
+        try:
+            with open(QUOTE_CACHE_FILE, "rb") as f:
+                return json_loads(f.read())
+        except JSONDecodeError:
+            return {}
+    return {}
+
+def atomic_write(path, data):
+    """임시 파일에 먼저 쓴 뒤 os.replace로 교체해, 쓰는 도중 중단되거나 다른 프로세스가 동시에 읽어도 쓰다 만 파일이 보이지 않도록 함"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def save_quote_cache(cache):
+    atomic_write(QUOTE_CACHE_FILE, json_dumps(cache))
+
+def fetch_quotes(symbols):
+    """
+    심볼별 캐시 유효 시간 이내에 조회한 심볼은 디스크 캐시에서 꺼내고, 나머지만 Yahoo에 요청합니다.
+    Yahoo 조회에 실패한 심볼은 QUOTE_STALE_MAX 이내의 만료된 캐시라도 마지막으로 받은 시세를 대신 사용합니다.
+    (이때 "stale": True와 캐시 시각 "cached_ts"를 붙여 반환)
+    """
+    now = time.time()
+    cache = load_quote_cache()
+    
+    quotes = {}
+    for symbol in symbols:
+        entry = cache.get(symbol)
+        ttl = QUOTE_CACHE_TTL_BY_SYMBOL.get(symbol, QUOTE_CACHE_TTL)
+        if entry and now - entry["ts"] < ttl:
+            quotes[symbol] = entry["quote"]
+    
+    missing = [s for s in symbols if s not in quotes]
+    if missing:
+        fetched = _fetch_quotes_remote(missing)
+        for symbol, quote in fetched.items():
+            # 가격이 비어 있는 응답은 캐시하지 않아야 다음 실행에서 다시 조회합니다.
+            # (이전에 받은 정상 시세는 실패 시 대체용으로 그대로 둡니다.)
+            if _has_price(quote):
+                cache[symbol] = {"ts": now, "quote": quote}
+        if any(_has_price(q) for q in fetched.values()):
+            save_quote_cache(cache)
+        quotes.update(fetched)
+        
+        for symbol in missing:
+            entry = cache.get(symbol)
+            if not _has_price(quotes.get(symbol)) and entry and now - entry["ts"] <= QUOTE_STALE_MAX:
+                logger.warning("'%s' 시세 조회 실패 → 마지막으로 받은 캐시 시세를 사용합니다.", symbol)
+                quotes[symbol] = dict(entry["quote"], stale=True, cached_ts=entry["ts"])
+    
+    return quotes
+
 # 1. 국내 금 가격 (ACE KRX금현물 ETF, 1g 추종)
-def get_korean_gold_data():
-    symbol = "411060.KS"  # ⚠️ (수정) 1g 추종 ACE 코드로 변경
+KOREAN_GOLD_SYMBOL = "411060.KS"  # ⚠️ (수정) 1g 추종 ACE 코드로 변경
+
+def get_korean_gold_data(quotes=None):
+    symbol = KOREAN_GOLD_SYMBOL
     try:
-        ticker = yf.Ticker(symbol)
-        data = ticker.info
+        if quotes is None:
+            quotes = fetch_quotes([symbol])
+        data = quotes.get(symbol, {})
         
-        # yfinance API의 'regularMarketPrice'가 비정상일 수 있으므로
+        # Yahoo의 'regularMarketPrice'가 비정상일 수 있으므로
         # 안정적인 'previousClose' (전일 종가)를 우선 사용합니다.
         market_price = data.get('previousClose')
         market_time = data.get('regularMarketTime') # 시간은 참고용으로만 사용
@@ -85,10 +345,11 @@ def get_korean_gold_data():
         raise RuntimeError(f"KRX 골드 ETF 가격 조회 실패: {type(e).__name__} - {e}")
 
 # 2. Yahoo Finance 가격 조회 (국제 금, 환율)
-def get_yahoo_price(symbol):
+def get_yahoo_price(symbol, quotes=None):
     try:
-        ticker = yf.Ticker(symbol)
-        data = ticker.info
+        if quotes is None:
+            quotes = fetch_quotes([symbol])
+        data = quotes.get(symbol, {})
         price = data.get('regularMarketPrice')
         if price is None:
             price = data.get('previousClose')
@@ -100,28 +361,120 @@ def get_yahoo_price(symbol):
     except Exception as e:
         raise RuntimeError(f"Yahoo Finance '{symbol}' 데이터 조회 실패: {type(e).__name__} - {e}")
 
-# 3. 모든 데이터 가져오기
+# 3. 모든 데이터 가져오기 (3개 심볼을 한 번의 요청으로 조회)
+# 주 심볼의 실시간 시세를 못 받았을 때 대신 조회할 심볼 (같은 단위로 호가되는 것만)
+QUOTE_FALLBACK_SYMBOLS = {
+    "GC=F": ["MGC=F"],      # 마이크로 금 선물 (온스당 USD)
+    "USDKRW=X": ["KRW=X"],  # 같은 원/달러 환율의 다른 티커
+}
+
 def get_gold_and_fx_data():
-    usd_krw = get_yahoo_price("USDKRW=X")  # 원/달러 환율
-    gold_usd = get_yahoo_price("GC=F")     # 국제 금 (1 온스 당 USD)
-    market_price, market_time = get_korean_gold_data() # 국내 ETF 가격
+    """
+    주 심볼 조회에 실패하면 대체 심볼 → 주 심볼 캐시 시세 → 대체 심볼 캐시 시세 순으로 채웁니다.
+    어떤 소스로 대체했는지는 substitutions 목록으로, 캐시 시세를 썼는지는 used_stale로 함께 반환합니다.
+    """
+    symbols = ["USDKRW=X", "GC=F", KOREAN_GOLD_SYMBOL]
+    quotes = fetch_quotes(symbols)
     
-    return market_price, usd_krw, gold_usd, market_time
+    def is_live(quote):
+        return _has_price(quote) and not quote.get("stale")
+    
+    def cached_at(quote):
+        return timestamp_to_kst(int(quote["cached_ts"]))
+    
+    substitutions = []
+    weak = [s for s in symbols if not is_live(quotes.get(s))]
+    alternates = [a for s in weak for a in QUOTE_FALLBACK_SYMBOLS.get(s, [])]
+    alt_quotes = fetch_quotes(alternates) if alternates else {}
+    for symbol in weak:
+        candidates = QUOTE_FALLBACK_SYMBOLS.get(symbol, [])
+        alt = next((a for a in candidates if is_live(alt_quotes.get(a))), None)
+        if alt:
+            quotes[symbol] = alt_quotes[alt]
+            substitutions.append(f"{symbol} → {alt}")
+        elif _has_price(quotes.get(symbol)):
+            substitutions.append(f"{symbol} → 마지막 캐시 시세 ({cached_at(quotes[symbol])})")
+        else:
+            # 주 심볼은 캐시조차 없으면 대체 심볼의 캐시 시세라도 사용합니다.
+            alt = next((a for a in candidates if _has_price(alt_quotes.get(a))), None)
+            if alt:
+                quotes[symbol] = alt_quotes[alt]
+                substitutions.append(f"{symbol} → {alt} (캐시, {cached_at(alt_quotes[alt])})")
+    
+    usd_krw = get_yahoo_price("USDKRW=X", quotes)  # 원/달러 환율
+    gold_usd = get_yahoo_price("GC=F", quotes)     # 국제 금 (1 온스 당 USD)
+    market_price, market_time = get_korean_gold_data(quotes) # 국내 ETF 가격
+    
+    used_stale = any(quotes[s].get("stale") for s in symbols)
+    return market_price, usd_krw, gold_usd, market_time, substitutions, used_stale
 
 # ---------- 데이터 처리 및 분석 ----------
 def load_history():
+    """히스토리를 최근 HISTORY_MAX개만 유지하는 deque로 읽어옵니다."""
+    history = deque(maxlen=HISTORY_MAX)
     if os.path.exists(DATA_FILE):
+        with open(DATA_FILE, "rb") as f:
+            size = f.seek(0, os.SEEK_END)
+            offset = max(0, size - HISTORY_TAIL_BYTES)
+            f.seek(offset)
+            lines = f.read().split(b"\n")
+            if offset:
+                lines = lines[1:]  # 중간부터 읽었으므로 첫 줄은 잘린 줄입니다.
+            for line in lines:
+                if not line:
+                    continue
+                try:
+                    record = json_loads(line)
+                except JSONDecodeError:
+                    continue  # 중간에 끊긴 줄은 건너뜁니다.
+                # 같은 날짜가 연달아 있으면(이전 버전의 저장 오류) 나중 기록만 남깁니다.
+                if history and history[-1].get("date") == record.get("date"):
+                    history[-1] = record
+                else:
+                    history.append(record)
+        return history
+    
+    # JSONL 파일이 아직 없으면 이전 형식의 JSON 배열을 읽어 이어서 사용
+    if os.path.exists(LEGACY_DATA_FILE):
         try:
-            with open(DATA_FILE, "r") as f:
-                return json.load(f)
-        except json.JSONDecodeError:
-            return []
-    return []
+            with open(LEGACY_DATA_FILE, "rb") as f:
+                history.extend(json_loads(f.read()))
+        except JSONDecodeError:
+            pass
+    return history
 
-def save_history(data):
-    data = data[-100:]
-    with open(DATA_FILE, "w") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+def recent(history, n=7):
+    """deque 히스토리에서 최근 n개 기록을 리스트로 반환 (deque는 슬라이싱 불가)"""
+    return list(islice(history, max(0, len(history) - n), None))
+
+def rolling_sum7(history):
+    """
+    오늘 기록(history[-1])까지 최근 7개 괴리율의 합을 계산합니다.
+    직전 sum7에서 이어 더하면 기록이 한 줄만 빠져도 오차가 계속 남으므로 매번 7개를 직접 더합니다.
+    """
+    return sum(h["premium"] for h in recent(history))
+
+def save_history(data, replace_last=False):
+    """
+    마지막 기록(data[-1]) 한 줄만 파일 끝에 추가합니다.
+    replace_last=True이면 파일의 마지막 줄을 잘라내고 새 기록으로 교체합니다.
+    파일이 없거나 HISTORY_TRIM_THRESHOLD 줄을 넘으면 data(최근 HISTORY_MAX개)로 다시 씁니다.
+    """
+    if os.path.exists(DATA_FILE):
+        with open(DATA_FILE, "rb+") as f:
+            content = f.read()
+            if content.count(b"\n") < HISTORY_TRIM_THRESHOLD:
+                # 이전 실행이 줄 중간에 끊겼으면 그 조각부터 잘라낸 뒤,
+                # replace_last일 때는 마지막 완전한 기록 한 줄을 더 잘라냅니다.
+                end = content.rfind(b"\n") + 1
+                if replace_last:
+                    end = content[:end].rstrip(b"\n").rfind(b"\n") + 1
+                f.truncate(end)
+                f.seek(end)
+                f.write(json_dumps(data[-1]) + b"\n")
+                return
+
+    atomic_write(DATA_FILE, b"".join(json_dumps(record) + b"\n" for record in data))
 
 # (핵심) calc_premium: 이론적 NAV를 1g 기준으로 계산
 def calc_premium():
@@ -129,7 +482,7 @@ def calc_premium():
     국제 금 시세와 환율을 기준으로 1g 이론적 NAV를 계산하고,
     국내 1g 추종 ETF 시장 가격과 비교하여 프리미엄(괴리율)을 계산합니다.
     """
-    market_price, usd_krw, gold_usd, market_time = get_gold_and_fx_data()
+    market_price, usd_krw, gold_usd, market_time, substitutions, used_stale = get_gold_and_fx_data()
     
     # 1. 국제 금 1g당 달러 가격 계산
     gold_usd_per_gram = gold_usd / TROY_Ounce_TO_GRAM
@@ -140,6 +493,10 @@ def calc_premium():
     # 3. 프리미엄(괴리율) 계산: (실제 시장가 / 1g 이론적 NAV) - 1
     premium = (market_price / theoretical_nav_1g - 1) * 100
     
+    warning_msg = "✅ 1g 이론적 NAV 기준 (전일 종가 기준)"
+    if substitutions:
+        warning_msg += f"\n⚠️ 대체 시세 사용: {', '.join(substitutions)}"
+    
     return {
         "korean": market_price,           # 국내 ETF 시장가 (원)
         "international_krw": theoretical_nav_1g, # 국제 금 1g 이론가 (원)
@@ -147,37 +504,118 @@ def calc_premium():
         "gold_usd": gold_usd,              # 국제 금 (달러/온스)
         "premium": premium,              # 괴리율 (%)
         "market_time": market_time,        # ETF 시장 시간
-        "warning_msg": "✅ 1g 이론적 NAV 기준 (전일 종가 기준)" 
+        "warning_msg": warning_msg,
+        "used_stale": used_stale,          # 캐시 시세로 계산했는지 여부
     }
 
+_graph_canvas = None
+
+def get_graph_canvas():
+    """그래프용 Figure/Agg 캔버스를 처음 한 번만 만들고 이후 호출에서는 재사용"""
+    global _graph_canvas
+    if _graph_canvas is None:
+        import matplotlib
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        
+        # 폰트 대체 탐색과 자동 레이아웃 계산을 피하도록 스타일을 한 번만 고정
+        matplotlib.rcParams.update({
+            "figure.autolayout": False,
+            "font.family": "DejaVu Sans",
+            "path.simplify": True,
+        })
+        
+        # pyplot 상태 머신과 tight_layout 계산을 거치지 않도록 Figure/Agg 캔버스를 직접 사용
+        fig = Figure(figsize=(6, 3), dpi=80)  # 7개 점짜리 차트라 낮은 해상도로 충분
+        fig.add_subplot()
+        fig.subplots_adjust(left=0.12, right=0.98, top=0.88, bottom=0.32)
+        _graph_canvas = FigureCanvasAgg(fig)
+    return _graph_canvas
+
 def create_graph(history):
-    history = history[-7:]
+    history = recent(history)
     if len(history) < 2: return None
         
     dates = [x["date"] for x in history]
     premiums = [x["premium"] for x in history]
 
-    plt.figure(figsize=(6, 3))
-    plt.plot(dates, premiums, marker="o")
-    plt.title("ETF 괴리율 7일 추세 (%)")
-    plt.ylabel("괴리율(%)")
-    plt.xticks(rotation=45, ha='right')
-    plt.grid(True, alpha=0.3)
-    plt.tight_layout()
+    # 그릴 데이터가 지난번과 같으면 matplotlib 렌더링 없이 저장된 PNG를 재사용
+    # (내장 hash()는 실행마다 값이 달라지므로 hashlib 사용)
+    sig = hashlib.sha1(
+        json_dumps([[d, round(p, 2)] for d, p in zip(dates, premiums)])
+    ).hexdigest()
+    try:
+        with open(GRAPH_SIG_FILE, encoding="utf-8") as f:
+            prev_sig = f.read().strip()
+        if sig == prev_sig:
+            with open(GRAPH_CACHE_FILE, "rb") as f:
+                return BytesIO(f.read())
+    except OSError:
+        pass
+
+    canvas = get_graph_canvas()
+    ax = canvas.figure.axes[0]
+    ax.cla()
+    ax.plot(dates, premiums, marker="o")
+    ax.set_title("ETF 괴리율 7일 추세 (%)")
+    ax.set_ylabel("괴리율(%)")
+    for label in ax.get_xticklabels():
+        label.set_rotation(45)
+        label.set_horizontalalignment('right')
+    ax.grid(True, alpha=0.3)
 
     buf = BytesIO()
-    plt.savefig(buf, format="png")
-    plt.close()
+    canvas.print_png(buf)
+    try:
+        with open(GRAPH_CACHE_FILE, "wb") as f:
+            f.write(buf.getvalue())
+        with open(GRAPH_SIG_FILE, "w", encoding="utf-8") as f:
+            f.write(sig)
+    except OSError as e:
+        logger.warning("그래프 캐시 저장 실패: %s", e)
     buf.seek(0)
     return buf
 
-def analyze_with_ai(today_msg, history):
+def ai_cache_path(history, note=""):
+    """
+    오늘 괴리율(소수 둘째 자리)과 최근 7일 (날짜, 괴리율), 대체 시세 안내가 같으면 같은 캐시 파일을 가리키도록 해시 키 생성
+    (금/환율 시세의 잔 변동은 요약 내용에 영향이 없으므로 키에 넣지 않습니다.)
+    """
+    tail = [{"date": h["date"], "premium": h["premium"]} for h in recent(history)]
+    fingerprint = {"premium": round(history[-1]["premium"], 2), "tail": tail, "note": note}
+    key = hashlib.sha1(json_dumps(fingerprint, sort_keys=True)).hexdigest()
+    return os.path.join(AI_CACHE_DIR, f"{key}.txt")
+
+def is_ai_cache_fresh(path):
+    return os.path.exists(path) and time.time() - os.path.getmtime(path) < AI_CACHE_TTL
+
+def prune_ai_cache():
+    """유효 시간이 지난 AI 요약 캐시 파일을 정리 (직전 요약 파일은 유지)"""
+    for name in os.listdir(AI_CACHE_DIR):
+        path = os.path.join(AI_CACHE_DIR, name)
+        if path != AI_LAST_SUMMARY_FILE and not is_ai_cache_fresh(path):
+            os.remove(path)
+
+def analyze_with_ai(today_msg, history, reuse_last=False, cache_note=""):
+    # 변동이 미미한 날은 직전 요약을 그대로 사용합니다. (유효 시간이 지난 요약은 재사용하지 않음)
+    if reuse_last and is_ai_cache_fresh(AI_LAST_SUMMARY_FILE):
+        with open(AI_LAST_SUMMARY_FILE, "r", encoding="utf-8") as f:
+            return f"(변동 미미 – 이전 요약 재사용)\n{f.read()}"
+
+    # 동일한 입력으로 이미 받은 요약이 있으면 OpenAI를 다시 호출하지 않습니다.
+    cache_path = ai_cache_path(history, cache_note)
+    if is_ai_cache_fresh(cache_path):
+        with open(cache_path, "r", encoding="utf-8") as f:
+            return f.read()
+
+    openai_client = get_openai_client()
     if not openai_client:
-        return "AI 분석 오류: OpenAI 클라이언트 초기화 실패 (API 키 누락)"
+        logger.warning("AI 분석 생략: OpenAI 클라이언트 초기화 실패 (API 키 누락)")
+        return None
             
     prompt = f"""
 다음은 최근 7일간의 ACE KRX금현물 ETF 괴리율 데이터입니다. (괴리율 = (국내 ETF 가격 / 국제 금 1g 원화환산가) - 1)
-{json.dumps(history[-7:], ensure_ascii=False, indent=2)}
+{json_dumps(recent(history)).decode()}
 
 오늘의 주요 데이터:
 {today_msg}
@@ -189,15 +627,27 @@ def analyze_with_ai(today_msg, history):
             model="gpt-4o-mini",
             messages=[{"role": "user", "content": prompt}],
             temperature=0.6,
+            max_tokens=AI_MAX_TOKENS,
+            timeout=AI_TIMEOUT,
         )
-        return response.choices[0].message.content.strip()
+        summary = response.choices[0].message.content.strip()
     except Exception as e:
-        return f"AI 분석 오류: {e}"
+        logger.warning("AI 분석 오류: %s", e)
+        return None
+
+    os.makedirs(AI_CACHE_DIR, exist_ok=True)
+    prune_ai_cache()
+    for path in (cache_path, AI_LAST_SUMMARY_FILE):
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(summary)
+    return summary
 
 # (핵심 수정) main: 텍스트 ACE 기준으로 수정
 def main():
     try:
-        today = datetime.date.today().isoformat()
+        # 현재 시각은 한 번만 읽어 날짜와 기준 일시 문자열에 같이 씁니다.
+        now = datetime.datetime.now(KST)
+        today = now.strftime("%Y-%m-%d")
         
         info = calc_premium()
         history = load_history()
@@ -207,49 +657,67 @@ def main():
         final_timestamp = info["market_time"]
         
         # 유효한 현재 데이터만 히스토리에 저장
-        if history and history[-1]["date"] == today:
+        replace_last = bool(history) and history[-1]["date"] == today
+        if replace_last:
             history[-1] = {"date": today, "premium": round(current_premium, 2)}
         else:
             history.append({"date": today, "premium": round(current_premium, 2)})
+        history[-1]["sum7"] = round(rolling_sum7(history), 4)
         
-        save_history(history)
+        # 캐시 시세로 계산한 괴리율은 이번 메시지에만 쓰고 히스토리에는 남기지 않습니다.
+        if not info["used_stale"]:
+            save_history(history, replace_last)
 
-        prev_premium_data = [h for h in history if h["date"] != today]
-        prev = prev_premium_data[-1]["premium"] if prev_premium_data else info["premium"]
+        # 히스토리는 날짜순이고 오늘 기록이 항상 마지막이므로 전일 값은 바로 앞 항목입니다.
+        prev = history[-2]["premium"] if len(history) >= 2 else info["premium"]
         change = info["premium"] - prev
         
-        last7 = [x["premium"] for x in history[-7:]]
-        avg7 = sum(last7)/len(last7) if last7 else 0
+        avg7 = history[-1]["sum7"] / min(len(history), 7)
         level = "고평가" if info["premium"] > avg7 else "저평가"
+        is_quiet = abs(change) < AI_NOISE_CHANGE and abs(info["premium"] - avg7) < AI_NOISE_AVG
         trend = "📈 상승세" if change > 0 else "📉 하락세"
             
         # 최종 집계 시간 문자열 생성
         if isinstance(final_timestamp, int):
             time_str = f"실시간 ({timestamp_to_kst(final_timestamp)})"
         else:
-            time_str = f"현재 ({datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S KST')})"
+            time_str = f"현재 ({now.strftime('%Y-%m-%d %H:%M:%S KST')})"
             
         # 텔레그램 메시지 구성 (ACE 및 1g 기준으로 텍스트 수정)
-        msg_data = (
-            f"📅 {today} ACE KRX금현물 ETF 괴리율 알림\n"
-            f"기준 일시: {time_str}\n"
-            f"{info['warning_msg']}\n"
-            f"국내 ETF 시장가 (주당): {info['korean']:,.0f}원\n"
-            f"국제 금 1g 이론가 (NAV): {info['international_krw']:,.0f}원\n"
-            f"국제 금시세 (oz): ${info['gold_usd']:,.2f}\n"
-            f"환율: {info['usd_krw']:,.2f}원/$\n"
-            f"👉 ETF 괴리율: {info['premium']:+.2f}% ({change:+.2f}% vs 전일)\n"
-            f"최근 7일 평균 대비: {level} ({avg7:.2f}%) {trend}"
-        )
+        msg_data = "\n".join([
+            f"📅 {today} ACE KRX금현물 ETF 괴리율 알림",
+            f"기준 일시: {time_str}",
+            info['warning_msg'],
+            f"국내 ETF 시장가 (주당): {info['korean']:,.0f}원",
+            f"국제 금 1g 이론가 (NAV): {info['international_krw']:,.0f}원",
+            f"국제 금시세 (oz): ${info['gold_usd']:,.2f}",
+            f"환율: {info['usd_krw']:,.2f}원/$",
+            f"👉 ETF 괴리율: {info['premium']:+.2f}% ({change:+.2f}% vs 전일)",
+            f"최근 7일 평균 대비: {level} ({avg7:.2f}%) {trend}",
+        ])
         
-        ai_summary = analyze_with_ai(msg_data, history)
-        full_msg = f"{msg_data}\n\n🤖 AI 요약:\n{ai_summary}"
-
-        send_telegram_text(full_msg)
+        # AI 프롬프트/캐시 키에는 날짜와 괴리율만 넘깁니다. (sum7은 내부 집계용)
+        tail7 = [{"date": h["date"], "premium": h["premium"]} for h in recent(history)]
+        
+        # AI 분석(수 초 걸리는 네트워크 호출)은 백그라운드에서 돌리고,
+        # 그동안 그래프를 그려 데이터 메시지를 먼저 발송한 뒤 AI 요약을 후속 메시지로 보냅니다.
+        executor = ThreadPoolExecutor(max_workers=1)
+        ai_future = executor.submit(analyze_with_ai, msg_data, tail7, is_quiet, info["warning_msg"])
+        try:
+            graph_buf = create_graph(history)
+            if graph_buf:
+                send_telegram_photo(graph_buf, caption=fit_caption(msg_data))
+            else:
+                send_telegram_text(msg_data)
+            
+            ai_summary = ai_future.result()
+        finally:
+            # 데이터 발송이 실패하면 AI 응답을 기다리지 않고 바로 오류 알림으로 넘어갑니다.
+            executor.shutdown(wait=False, cancel_futures=True)
 
-        graph_buf = create_graph(history)
-        if graph_buf:
-            send_telegram_photo(graph_buf, caption="📈 최근 7일 ETF 괴리율 추세")
+        # AI 분석이 실패했거나 API 키가 없으면 후속 메시지를 보내지 않습니다. (경고 로그만 남김)
+        if ai_summary:
+            send_telegram_text(f"🤖 AI 요약:\n{ai_summary}")
 
     except Exception as e:
         try: